@@ -1,17 +1,85 @@
+import collections
+import functools
 import logging
 import os
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 import numpy as np
 import psutil
 import torch
 import torch.distributed as dist
+from transformers.file_utils import is_faiss_available
+from transformers.models.rag.retrieval_rag import HFIndexBase
 
 from dialdoc.models.rag.retrieval_rag_dialdoc import DialDocRagRetriever
 
 
+if is_faiss_available():
+    import faiss
+
+
 logger = logging.getLogger(__name__)
 
+# up to this many workers, gloo retrieval traffic uses point-to-point transfers instead of collectives
+P2P_MAX_WORLD_SIZE = 2
+
+
+def _route_source_address(host):
+    # connecting a udp socket sends nothing, it only makes the kernel pick the route (and local address) to host
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((host, 1))
+            return sock.getsockname()[0]
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def _infer_socket_ifname():
+    addrs = psutil.net_if_addrs()
+    ipv4_addrs = {
+        name: {addr.address for addr in if_addrs if addr.family == socket.AF_INET} for name, if_addrs in addrs.items()
+    }
+
+    # the interface that owns the local end of the route to the master is the one every node can be reached on
+    master_addr = os.environ.get("MASTER_ADDR")
+    source_addr = _route_source_address(master_addr) if master_addr else None
+    if source_addr is not None and not source_addr.startswith("127."):
+        ifname = next((name for name, name_addrs in ipv4_addrs.items() if source_addr in name_addrs), None)
+        if ifname is not None:
+            return ifname
+
+    # otherwise only interfaces backed by a device qualify, bridges (docker0, cni0, virbr0) report the speed of
+    # their fastest port and are host-local. The link speed (0 if unknown) only breaks ties
+    stats = psutil.net_if_stats()
+    candidates = [
+        name
+        for name, name_addrs in ipv4_addrs.items()
+        if name_addrs and name in stats and stats[name].isup and os.path.exists(f"/sys/class/net/{name}/device")
+    ]
+    if candidates:
+        return max(candidates, key=lambda name: (name.startswith("e"), stats[name].speed))
+    # a hacky way to deal with varying network interface names
+    ifname = next((addr for addr in addrs if addr.startswith("e")), None)
+    return ifname
+
+
+def _faiss_num_threads(concurrent_searches=1):
+    # RAG_FAISS_NUM_THREADS overrides the default, which splits the cores this process may run on (respecting
+    # affinity/cgroup cpusets) between the index searches running at the same time
+    if "RAG_FAISS_NUM_THREADS" in os.environ:
+        return int(os.environ["RAG_FAISS_NUM_THREADS"])
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return max(1, available // concurrent_searches)
+
+
+def _set_faiss_num_threads(n_threads):
+    if is_faiss_available():
+        faiss.omp_set_num_threads(n_threads)
+
 
 class RagPyTorchDistributedRetriever(DialDocRagRetriever):
     """
@@ -40,6 +108,17 @@ class RagPyTorchDistributedRetriever(DialDocRagRetriever):
             init_retrieval=False,
         )
         self.process_group = None
+        self._retrieval_executor = None
+        # persistent communication buffers, see _get_buffer
+        self._buffers = {}
+        # the same passages are retrieved over and over during training, so their rows are cached per passage id
+        # within a memory budget of RAG_DOC_CACHE_MB megabytes
+        self._doc_cache = collections.OrderedDict()
+        self._doc_cache_nbytes = 0
+        self._doc_cache_max_nbytes = int(float(os.environ.get("RAG_DOC_CACHE_MB", 64)) * 2 ** 20)
+        self._device = torch.device("cpu")
+        # query and doc vectors are sent in half precision, set RAG_RETRIEVAL_WIRE_FP32=1 to debug numerical issues
+        self.wire_dtype = torch.float32 if os.environ.get("RAG_RETRIEVAL_WIRE_FP32", "0") == "1" else torch.float16
 
     def init_retrieval(self, distributed_port: int):
         """
@@ -54,39 +133,262 @@ class RagPyTorchDistributedRetriever(DialDocRagRetriever):
 
         logger.info("initializing retrieval")
 
-        # initializing a separate process group for retrieval as the default
-        # nccl backend doesn't support gather/scatter operations while gloo
-        # is too slow to replace nccl for the core gpu communication
-        if dist.is_initialized():
+        # initializing a separate process group for retrieval. It uses gloo, unless RAG_RETRIEVAL_BACKEND=nccl is set
+        # when training on gpus: the queries arrive and the index lives in cpu memory, so nccl adds a host-to-device
+        # copy on every worker and a device-to-host/host-to-device pair on the main worker. The group is only created
+        # once, even if init_retrieval is called again
+        if dist.is_initialized() and self.process_group is None:
             logger.info("dist initialized")
-            # needs to be set manually
-            os.environ["GLOO_SOCKET_IFNAME"] = self._infer_socket_ifname()
             # avoid clash with the NCCL port
             os.environ["MASTER_PORT"] = str(distributed_port + 1)
-            self.process_group = dist.new_group(ranks=None, backend="gloo")
+            if os.environ.get("RAG_RETRIEVAL_BACKEND", "gloo") == "nccl" and torch.cuda.is_available():
+                # the trainer only sets the device of each process after this call, see _retrieval_device
+                self._device = None
+                self.process_group = dist.new_group(ranks=None, backend="nccl")
+            else:
+                # needs to be set manually, unless it was already pinned for this run
+                ifname = os.environ.get("GLOO_SOCKET_IFNAME") or _infer_socket_ifname()
+                if ifname is not None:
+                    os.environ["GLOO_SOCKET_IFNAME"] = ifname
+                logger.info(f"using network interface {ifname} for retrieval")
+                self.process_group = dist.new_group(ranks=None, backend="gloo")
+            # checked once here instead of on every retrieve: the retrieval buffers are sized for every worker of
+            # the training run sending its queries
+            assert dist.get_world_size(group=self.process_group) == dist.get_world_size()
 
         # initialize retriever only on the main worker
         if not dist.is_initialized() or self._is_main():
             logger.info("dist not initialized / main")
             self.index.init_index()
+            # launchers commonly export OMP_NUM_THREADS=1 for every training process, which would leave the batched
+            # index search of the main worker (which serves all workers) on a single core. The OpenMP thread count
+            # is per thread, so it is set for this thread and for the executor thread
+            world_size = dist.get_world_size(group=self.process_group) if dist.is_initialized() else 1
+            faiss_threads = _faiss_num_threads(concurrent_searches=2 if world_size > 1 else 1)
+            _set_faiss_num_threads(faiss_threads)
+            # runs the main worker's own index search while the queries of the other workers are in flight
+            if self._retrieval_executor is None:
+                self._retrieval_executor = ThreadPoolExecutor(
+                    max_workers=1, initializer=_set_faiss_num_threads, initargs=(faiss_threads,)
+                )
 
-        # all processes wait untill the retriever is initialized by the main process
-        if dist.is_initialized():
+        # all processes wait untill the retriever is initialized by the main process. An nccl barrier would run on a
+        # device guessed from the rank, so there the first gather of retrieve, which the main worker only joins once
+        # the index is loaded, does the waiting instead
+        if dist.is_initialized() and self._device is not None:
             torch.distributed.barrier(group=self.process_group)
 
+    def _retrieval_device(self):
+        if self._device is None:
+            # resolved on the first retrieve, by when the trainer has set the device of this process
+            self._device = torch.device("cuda", torch.cuda.current_device())
+        return self._device
+
     def _is_main(self):
         return dist.get_rank(group=self.process_group) == 0
 
-    def _scattered(self, scatter_list, target_shape, target_type=torch.float32):
-        target_tensor = torch.empty(target_shape, dtype=target_type)
-        dist.scatter(target_tensor, src=0, scatter_list=scatter_list, group=self.process_group)
-        return target_tensor
+    def _scattered(self, payload, n_queries):
+        # gloo implements broadcast with a tree while scatter is a linear series of sends from the root (and nccl
+        # has no scatter at all), so the full payload is broadcast and every rank keeps only its own slice
+        work = dist.broadcast(payload, src=0, group=self.process_group, async_op=True)
+        rank = dist.get_rank(group=self.process_group)
+        return payload[rank * n_queries : (rank + 1) * n_queries], [work]
 
-    def _infer_socket_ifname(self):
-        addrs = psutil.net_if_addrs()
-        # a hacky way to deal with varying network interface names
-        ifname = next((addr for addr in addrs if addr.startswith("e")), None)
-        return ifname
+    @staticmethod
+    def _doc_nbytes(doc):
+        return sum(value.nbytes if isinstance(value, np.ndarray) else sys.getsizeof(value) for value in doc.values())
+
+    def _get_docs(self, doc_ids):
+        """
+        Returns the row of every passage in ``doc_ids``, fetching the ones missing from the cache from the dataset in
+        a single lookup. Least recently used rows are evicted once the cache exceeds its memory budget.
+        """
+        missing = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id not in self._doc_cache]
+        if missing:
+            rows = self.index.dataset[missing]
+            for i, doc_id in enumerate(missing):
+                # copies, so a cached row doesn't keep the whole fetched batch alive
+                doc = {
+                    column: np.array(values[i]) if isinstance(values, np.ndarray) else values[i]
+                    for column, values in rows.items()
+                }
+                self._doc_cache[doc_id] = doc
+                self._doc_cache_nbytes += self._doc_nbytes(doc)
+
+        docs = []
+        for doc_id in doc_ids:
+            self._doc_cache.move_to_end(doc_id)
+            docs.append(self._doc_cache[doc_id])
+        while self._doc_cache_nbytes > self._doc_cache_max_nbytes and self._doc_cache:
+            _, doc = self._doc_cache.popitem(last=False)
+            self._doc_cache_nbytes -= self._doc_nbytes(doc)
+        return docs
+
+    def _get_doc_dicts(self, doc_ids):
+        # only indexes backed by a dataset expose single passages, the others keep their own lookup
+        if not isinstance(self.index, HFIndexBase):
+            return self.index.get_doc_dicts(doc_ids)
+        doc_dicts = []
+        for row in doc_ids.tolist():
+            docs = self._get_docs(row)
+            # same layout as HFIndexBase.get_doc_dicts: numpy columns (the embeddings) are stacked, others are lists
+            doc_dicts.append(
+                {
+                    column: np.stack([doc[column] for doc in docs])
+                    if isinstance(docs[0][column], np.ndarray)
+                    else [doc[column] for doc in docs]
+                    for column in docs[0]
+                }
+            )
+        return doc_dicts
+
+    def _chunk_tensor(self, t, chunk_size):
+        # torch tensors are split into per-rank views in one call, everything else (numpy arrays, lists of domains)
+        # keeps the generic python slicing
+        if not isinstance(t, torch.Tensor):
+            return super()._chunk_tensor(t, chunk_size)
+        assert t.shape[0] % chunk_size == 0, "every worker has to send the same number of queries"
+        return list(torch.tensor_split(t, t.shape[0] // chunk_size, dim=0))
+
+    @property
+    def _wire_np_dtype(self):
+        return np.dtype(np.float32 if self.wire_dtype == torch.float32 else np.float16)
+
+    def _use_point_to_point(self, world_size):
+        # gloo collectives regress against plain isend/irecv on very small groups
+        return self._device.type == "cpu" and world_size <= P2P_MAX_WORLD_SIZE
+
+    def _gather_queries(self, fused_hidden_states, world_size):
+        """
+        Starts collecting the fused queries of all workers on the main worker. Returns the gather buffer (``None`` on
+        workers that don't receive anything) and the work handles that have to be waited on before it is read.
+        """
+        n_queries, width = fused_hidden_states.shape
+        if self._device.type == "cuda":
+            # nccl has no gather, every rank all-gathers into one flat buffer instead
+            gather_buffer = self._get_buffer("gather", (world_size * n_queries, width))
+            all_gather_into_tensor = getattr(dist, "all_gather_into_tensor", None) or dist._all_gather_base
+            work = all_gather_into_tensor(gather_buffer, fused_hidden_states, group=self.process_group, async_op=True)
+            return gather_buffer, [work]
+
+        gather_buffer = None
+        gather_list = None
+        if self._is_main():
+            # gloo has no _all_gather_base, so gather writes straight into row views of one contiguous buffer
+            gather_buffer = self._get_buffer("gather", (world_size * n_queries, width))
+            gather_list = self._chunk_tensor(gather_buffer, n_queries)
+
+        if self._use_point_to_point(world_size):
+            if self._is_main():
+                ops = [
+                    dist.P2POp(dist.irecv, gather_list[rank], rank, group=self.process_group)
+                    for rank in range(1, world_size)
+                ]
+            else:
+                ops = [dist.P2POp(dist.isend, fused_hidden_states, 0, group=self.process_group)]
+            return gather_buffer, dist.batch_isend_irecv(ops)
+
+        work = dist.gather(
+            fused_hidden_states, dst=0, gather_list=gather_list, group=self.process_group, async_op=True
+        )
+        return gather_buffer, [work]
+
+    def _send_results(self, payload, world_size, n_queries, width):
+        """
+        Starts sending every worker its rows of the packed results held by the main worker. Returns the local rows and
+        the work handles that have to be waited on before the rows are read (on the main worker, before ``payload``
+        is released). On workers other than the main one ``payload`` is ``None``.
+        """
+        if not self._use_point_to_point(world_size):
+            if payload is None:
+                payload = self._get_buffer("results", (world_size * n_queries, width))
+            return self._scattered(payload, n_queries)
+
+        if self._is_main():
+            ops = [
+                dist.P2POp(dist.isend, chunk, rank, group=self.process_group)
+                for rank, chunk in enumerate(self._chunk_tensor(payload, n_queries))
+                if rank > 0
+            ]
+            return payload[:n_queries], dist.batch_isend_irecv(ops)
+
+        target_tensor = self._get_buffer("results", (n_queries, width))
+        return target_tensor, [dist.irecv(target_tensor, src=0, group=self.process_group)]
+
+    def _get_buffer(self, name, shape, dtype=None, device=None):
+        """
+        Returns a persistent buffer for the communication step ``name``. The buffer is only reallocated when it has
+        fewer rows than requested or a different row size, dtype or device, otherwise a (contiguous) view of its first
+        ``shape[0]`` rows is returned, e.g. for the last, smaller batch of an epoch. Host buffers are page-locked when
+        the retrieval group runs on gpus, as they feed or drain device copies.
+
+        The contents are overwritten by the next call to :meth:`retrieve`, so anything that outlives a call has to be
+        copied out; :meth:`_unpack_results` always does.
+        """
+        dtype = dtype if dtype is not None else self.wire_dtype
+        device = device if device is not None else self._device
+        buffer = self._buffers.get(name)
+        if (
+            buffer is None
+            or buffer.shape[0] < shape[0]
+            or tuple(buffer.shape[1:]) != tuple(shape[1:])
+            or buffer.dtype != dtype
+            or buffer.device != device
+        ):
+            pin_memory = device.type == "cpu" and self._device.type == "cuda"
+            buffer = torch.empty(shape, dtype=dtype, device=device, pin_memory=pin_memory)
+            self._buffers[name] = buffer
+        return buffer[: shape[0]]
+
+    def _to_host(self, name, tensor):
+        # copies device tensors through a pinned host buffer instead of allocating a fresh pageable one
+        if tensor.device.type == "cpu":
+            return tensor
+        host_buffer = self._get_buffer(name, tuple(tensor.shape), dtype=tensor.dtype, device=torch.device("cpu"))
+        host_buffer.copy_(tensor)
+        return host_buffer
+
+    @staticmethod
+    def _split_queries(fused, vector_size):
+        # the index is searched with contiguous float32 queries
+        return tuple(
+            np.ascontiguousarray(fused[:, i * vector_size : (i + 1) * vector_size], dtype=np.float32) for i in range(3)
+        )
+
+    def _packed_width(self, n_docs, vector_size):
+        # ids (sent as int32) and scores (float32) are reinterpreted, so they may take several wire slots each
+        slots = 4 // self._wire_np_dtype.itemsize
+        return slots * n_docs + n_docs * vector_size + slots * n_docs
+
+    def _pack_results(self, out, ids, vectors, scores):
+        """
+        Packs the retrieval results into ``out``, rows of a matrix of shape ``(n_queries, packed_width)`` and dtype
+        ``wire_dtype`` that is sent with one collective. Only the vectors are cast to the wire dtype, the ids and
+        scores are reinterpreted bit-for-bit, so they round-trip exactly through :meth:`_unpack_results`.
+
+        The ids are sent as int32, which assumes the index holds less than 2**31 passages.
+        """
+        n_queries = ids.shape[0]
+        assert ids.size == 0 or ids.max() < 2 ** 31, "doc ids don't fit into int32"
+        packed_ids = np.ascontiguousarray(ids, dtype=np.int32).view(self._wire_np_dtype)
+        vectors = vectors.reshape(n_queries, -1)
+        ids_end = packed_ids.shape[1]
+        vectors_end = ids_end + vectors.shape[1]
+        out[:, :ids_end] = packed_ids
+        out[:, ids_end:vectors_end] = vectors
+        out[:, vectors_end:] = np.ascontiguousarray(scores.reshape(n_queries, -1), dtype=np.float32).view(
+            self._wire_np_dtype
+        )
+        return out
+
+    def _unpack_results(self, packed, n_docs, vector_size):
+        ids_end = (4 // self._wire_np_dtype.itemsize) * n_docs
+        vectors_end = ids_end + n_docs * vector_size
+        # np.array always copies, so nothing returned here aliases the communication buffers
+        doc_ids = np.array(packed[:, :ids_end]).view(np.int32).astype(np.int64)
+        retrieved_doc_embeds = packed[:, ids_end:vectors_end].astype(np.float32).reshape(-1, n_docs, vector_size)
+        doc_scores = np.array(packed[:, vectors_end:]).view(np.float32)
+        return doc_ids, retrieved_doc_embeds, doc_scores
 
     def retrieve(
         self,
@@ -99,7 +401,7 @@ class RagPyTorchDistributedRetriever(DialDocRagRetriever):
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[dict]]:
         """
         Retrieves documents for specified ``question_hidden_states``. The main process, which has the access to the index stored in memory, gathers queries
-        from all the processes in the main training process group, performs the retrieval and scatters back the results.
+        from all the processes in the main training process group, performs the retrieval and broadcasts back the results.
 
         Args:
             question_hidden_states (:obj:`np.ndarray` of shape :obj:`(batch_size, vector_size)`):
@@ -116,46 +418,74 @@ class RagPyTorchDistributedRetriever(DialDocRagRetriever):
                 The retrieved_doc_embeds examples per query.
         """
 
-        # single GPU training
-        if not dist.is_initialized():
+        # single GPU training, also when launched with an initialized process group of a single worker, where the
+        # gather and broadcast would only add latency
+        world_size = dist.get_world_size(group=self.process_group) if dist.is_initialized() else 1
+        if world_size == 1:
             doc_ids, retrieved_doc_embeds, doc_scores = self._main_retrieve(
                 combined_hidden_states, current_hidden_states, history_hidden_states, n_docs, dialog_lengths, domain
             )
-            return retrieved_doc_embeds, doc_ids, doc_scores, self.index.get_doc_dicts(doc_ids)
+            return retrieved_doc_embeds, doc_ids, doc_scores, self._get_doc_dicts(doc_ids)
 
         # distributed training
-        world_size = dist.get_world_size(group=self.process_group)
+        self._retrieval_device()
+        n_queries, vector_size = combined_hidden_states.shape
+        width = self._packed_width(n_docs, vector_size)
+
+        # gather logic: the three query matrices share the batch dimension, so they are fused
+        # into a single [n_queries, 3 * vector_size] buffer and sent with one collective
+        hidden_states = (combined_hidden_states, current_hidden_states, history_hidden_states)
+        staged_hidden_states = self._get_buffer("send", (n_queries, 3 * vector_size), device=torch.device("cpu"))
+        for i, states in enumerate(hidden_states):
+            # a single (casting) copy per matrix into the persistent staging buffer
+            staged_hidden_states[:, i * vector_size : (i + 1) * vector_size].copy_(torch.from_numpy(states))
+        fused_hidden_states = staged_hidden_states
+        if self._device.type == "cuda":
+            device_hidden_states = self._get_buffer("send_device", tuple(staged_hidden_states.shape))
+            fused_hidden_states = device_hidden_states.copy_(staged_hidden_states, non_blocking=True)
+        gather_buffer, works = self._gather_queries(fused_hidden_states, world_size)
 
-        # gather logic
-        gather_list_1 = None
-        gather_list_2 = None
-        gather_list_3 = None
+        # the main worker does not need to wait for the gather to search for its own queries. They are searched
+        # after the same rounding to the wire dtype as everybody else's, so the results don't depend on the rank
         if self._is_main():
-            gather_list_1 = [torch.empty(combined_hidden_states.shape, dtype=torch.float32) for _ in range(world_size)]
-            gather_list_2 = [torch.empty(current_hidden_states.shape, dtype=torch.float32) for _ in range(world_size)]
-            gather_list_3 = [torch.empty(history_hidden_states.shape, dtype=torch.float32) for _ in range(world_size)]
-        dist.gather(torch.tensor(combined_hidden_states), dst=0, gather_list=gather_list_1, group=self.process_group)
-        dist.gather(torch.tensor(current_hidden_states), dst=0, gather_list=gather_list_2, group=self.process_group)
-        dist.gather(torch.tensor(history_hidden_states), dst=0, gather_list=gather_list_3, group=self.process_group)
-
-        # scatter logic
-        n_queries = combined_hidden_states.shape[0]
-        scatter_ids = []
-        scatter_vectors = []
-        scatter_scores = []
+            local_future = self._retrieval_executor.submit(
+                self._main_retrieve,
+                *self._split_queries(staged_hidden_states.numpy(), vector_size),
+                n_docs,
+                dialog_lengths,
+                domain,
+            )
+        for work in works:
+            work.wait()
+
+        # scatter logic: ids, vectors and scores for all ranks are packed into a single buffer
         if self._is_main():
-            assert len(gather_list_1) == len(gather_list_2) == len(gather_list_3) == world_size
-            comb_h_s = torch.cat(gather_list_1).numpy()
-            curr_h_s = torch.cat(gather_list_2).numpy()
-            hist_h_s = torch.cat(gather_list_3).numpy()
+            # the index lives in cpu memory, so this is the only point where queries leave the device
+            gathered = self._to_host("gathered_host", gather_buffer[n_queries:]).numpy()
+            comb_h_s, curr_h_s, hist_h_s = self._split_queries(gathered, vector_size)
             ids, vectors, scores = self._main_retrieve(comb_h_s, curr_h_s, hist_h_s, n_docs, dialog_lengths, domain)
-            ids, vectors, scores = torch.tensor(ids), torch.tensor(vectors), torch.tensor(scores)
-            scatter_ids = self._chunk_tensor(ids, n_queries)
-            scatter_vectors = self._chunk_tensor(vectors, n_queries)
-            scatter_scores = self._chunk_tensor(scores, n_queries)
+            # both result sets are packed straight into their rows of the persistent payload buffer
+            payload = self._get_buffer("payload", (world_size * n_queries, width), device=torch.device("cpu"))
+            payload_rows = payload.numpy()
+            self._pack_results(payload_rows[n_queries:], ids, vectors, scores)
+            self._pack_results(payload_rows[:n_queries], *local_future.result())
+            if self._device.type == "cuda":
+                # the next call syncs the stream in _to_host before the host buffer is rewritten
+                payload = self._get_buffer("payload_device", tuple(payload.shape)).copy_(payload, non_blocking=True)
+        else:
+            payload = None
 
-        doc_ids = self._scattered(scatter_ids, [n_queries, n_docs], target_type=torch.int64)
-        retrieved_doc_embeds = self._scattered(scatter_vectors, [n_queries, n_docs, combined_hidden_states.shape[1]], torch.float32)
-        doc_scores = self._scattered(scatter_scores, [n_queries, n_docs], torch.float32)
+        packed, works = self._send_results(payload, world_size, n_queries, width)
+        if self._is_main():
+            # the main worker already holds its own rows, so it can look up their docs while the results of the
+            # other workers are still in flight
+            results = self._unpack_results(payload_rows[:n_queries], n_docs, vector_size)
+            doc_dicts = self._get_doc_dicts(results[0])
+        for work in works:
+            work.wait()
+        if not self._is_main():
+            results = self._unpack_results(self._to_host("results_host", packed).numpy(), n_docs, vector_size)
+            doc_dicts = self._get_doc_dicts(results[0])
 
-        return retrieved_doc_embeds.numpy(), doc_ids.numpy(), doc_scores.numpy(), self.index.get_doc_dicts(doc_ids)
+        doc_ids, retrieved_doc_embeds, doc_scores = results
+        return retrieved_doc_embeds, doc_ids, doc_scores, doc_dicts